@@ -1,21 +1,42 @@
 import os
+import re
+import json
 import time
 import sqlite3
+import queue
+import threading
+import heapq
 import datetime as dt
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from operator import itemgetter
 from dataclasses import dataclass
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Tuple
 
+import requests
 from dotenv import load_dotenv
 from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+from google.auth.transport.requests import AuthorizedSession, Request
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 
 try:
     from openai import OpenAI
 except Exception:
     OpenAI = None
 
+try:
+    import numpy as np
+except Exception:
+    np = None
+
+try:
+    from sentence_transformers import SentenceTransformer
+except Exception:
+    SentenceTransformer = None
+
 SCOPES = [
     "https://www.googleapis.com/auth/youtube.readonly",
     "https://www.googleapis.com/auth/youtube.force-ssl",
@@ -23,12 +44,55 @@ SCOPES = [
 TOKEN_FILE = "token.json"
 CLIENT_SECRET_FILE = "client_secret.json"
 DB_FILE = "yt_companion.sqlite3"
+SEMANTIC_CACHE_FILE = "yt_companion_cache.npz"
 
 load_dotenv()
 BOT_NAME = os.getenv("BOT_NAME", "Companion")
-ACHIEVEMENT_TIERS = [int(x.strip()) for x in os.getenv("ACHIEVEMENT_TIERS", "1,10,50,100").split(",")]
+# Whole-word, case-insensitive match so "companionship" doesn't count as a mention.
+BOT_MENTION = re.compile(r"(?<!\w)" + re.escape(BOT_NAME) + r"(?!\w)", re.IGNORECASE)
+ACHIEVEMENT_TIERS = frozenset(int(x.strip()) for x in os.getenv("ACHIEVEMENT_TIERS", "1,10,50,100").split(","))
 LLM_PROVIDER = os.getenv("LLM_PROVIDER", "none").lower()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
+CHAT_STREAMING = os.getenv("CHAT_STREAMING", "1") != "0"
+POLL_MIN_MS = int(os.getenv("POLL_MIN_MS", "1000"))
+POLL_MAX_MS = int(os.getenv("POLL_MAX_MS", "15000"))
+# "auto" caches only when a local encoder is installed. "1" also allows OpenAI
+# embeddings, which add an embeddings round trip to every cache miss.
+SEMANTIC_CACHE = os.getenv("SEMANTIC_CACHE", "auto").lower()
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "512"))
+LOCAL_EMBED_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+OPENAI_EMBED_MODEL = "text-embedding-3-small"
+AI_WORKERS = int(os.getenv("AI_WORKERS", "4"))
+SEND_INTERVAL_SECS = float(os.getenv("SEND_INTERVAL_SECS", "0.5"))
+USER_FLUSH_SECS = float(os.getenv("USER_FLUSH_SECS", "2"))
+STREAM_READ_TIMEOUT = float(os.getenv("STREAM_READ_TIMEOUT", "60"))
+STREAM_URL = "https://youtube.googleapis.com/youtube/v3/liveChat/messages/stream"
+
+HELP_TEXT = "Commands: !help, !stats, !uptime, !top. Ask AI with '?your question'."
+UPTIME_TEXT = "I’ve been here since the stream started."
+MODS_ONLY_TEXT = "Only mods or the owner can do that."
+SETTITLE_TEXT = "Title updates aren’t wired in this sample."
+UNKNOWN_TEXT = "Unknown command. Try !help"
+
+# Kept byte-identical across requests so OpenAI can reuse the cached prefix.
+SYSTEM_PROMPT = (
+    f"You are {BOT_NAME}, a witty but kind livestream co-host. "
+    f"Keep answers concise. "
+    f"Each user message is something a viewer said in chat."
+)
+PROMPT_CACHE_KEY = "yt-companion-v1"
+MAX_PROMPT_CHARS = 300
+REPLY_CACHE_SIZE = 1024
+
+TIER_MSG = {
+    1: "first message 🎉",
+    10: "10 messages 🔟",
+    50: "50 messages 🥳",
+    100: "100 messages 💯",
+    250: "250 messages 🚀",
+    500: "500 messages 🐐",
+}
 
 DDL = """
 CREATE TABLE IF NOT EXISTS users (
@@ -40,52 +104,137 @@ CREATE TABLE IF NOT EXISTS users (
 );
 """
 
+SQL_LOAD_USERS = "SELECT user_id, display_name, message_count, first_seen, last_seen FROM users"
+SQL_UPSERT_USER = (
+    "INSERT INTO users (user_id, display_name, message_count, first_seen, last_seen) VALUES (?,?,?,?,?) "
+    "ON CONFLICT(user_id) DO UPDATE SET display_name=excluded.display_name, "
+    "message_count=excluded.message_count, last_seen=excluded.last_seen"
+)
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL;",
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA busy_timeout=5000;",
+    "PRAGMA temp_store=MEMORY;",
+    "PRAGMA cache_size=-20000;",
+)
+
 def db_connect():
-    conn = sqlite3.connect(DB_FILE)
+    conn = sqlite3.connect(DB_FILE, isolation_level=None, check_same_thread=False)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
     conn.execute(DDL)
     return conn
 
-def upsert_user(conn, user_id: str, display_name: str):
-    now = dt.datetime.utcnow().isoformat()
-    cur = conn.cursor()
-    cur.execute("SELECT user_id, message_count FROM users WHERE user_id=?", (user_id,))
-    row = cur.fetchone()
-    if row:
-        cur.execute(
-            "UPDATE users SET display_name=?, last_seen=? WHERE user_id=?",
-            (display_name, now, user_id),
-        )
-    else:
-        cur.execute(
-            "INSERT INTO users (user_id, display_name, message_count, first_seen, last_seen) VALUES (?,?,?,?,?)",
-            (user_id, display_name, 0, now, now),
-        )
-    conn.commit()
-
-def bump_message_count(conn, user_id: str) -> int:
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET message_count = message_count + 1 WHERE user_id=?", (user_id,))
-    conn.commit()
-    cur.execute("SELECT message_count FROM users WHERE user_id=?", (user_id,))
-    return cur.fetchone()[0]
-
-def get_user_stats(conn, user_id: str) -> Optional[Dict[str, Any]]:
-    cur = conn.cursor()
-    cur.execute("SELECT display_name, message_count, first_seen, last_seen FROM users WHERE user_id=?", (user_id,))
-    row = cur.fetchone()
-    if not row: return None
-    return {
-        "display_name": row[0],
-        "message_count": row[1],
-        "first_seen": row[2],
-        "last_seen": row[3],
-    }
+@contextmanager
+def transaction(conn):
+    # The connection runs in autocommit mode, so group writes explicitly.
+    conn.execute("BEGIN")
+    try:
+        yield conn
+        conn.execute("COMMIT")
+    except BaseException:
+        # SQLite may already have rolled back (e.g. SQLITE_FULL); don't mask the error.
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+
+class UserCache:
+    # Hot copy of the users table. Messages only touch the dict; dirty rows are
+    # written back in one transaction every flush_interval seconds.
+    def __init__(self, conn, flush_interval: float = USER_FLUSH_SECS):
+        self.conn = conn
+        self.flush_interval = flush_interval
+        self.users: Dict[str, Dict[str, Any]] = {}
+        self.dirty = set()
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+        self._closed = False
+        for user_id, display_name, message_count, first_seen, last_seen in conn.execute(SQL_LOAD_USERS):
+            self.users[user_id] = {
+                "display_name": display_name,
+                "message_count": message_count,
+                "first_seen": first_seen,
+                "last_seen": last_seen,
+            }
+
+    def record(self, user_id: str, display_name: str, now: str) -> int:
+        with self._lock:
+            u = self.users.get(user_id)
+            if u is None:
+                u = self.users[user_id] = {
+                    "display_name": display_name,
+                    "message_count": 0,
+                    "first_seen": now,
+                    "last_seen": now,
+                }
+            u["display_name"] = display_name
+            u["last_seen"] = now
+            u["message_count"] += 1
+            self.dirty.add(user_id)
+            return u["message_count"]
+
+    def get(self, user_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            u = self.users.get(user_id)
+            return dict(u) if u else None
+
+    def top(self, limit: int) -> List[Dict[str, Any]]:
+        with self._lock:
+            top = heapq.nlargest(limit, self.users.values(), key=itemgetter("message_count"))
+            return [{"display_name": u["display_name"], "message_count": u["message_count"]} for u in top]
 
-def top_chatters(conn, limit=5) -> List[Dict[str, Any]]:
-    cur = conn.cursor()
-    cur.execute("SELECT display_name, message_count FROM users ORDER BY message_count DESC LIMIT ?", (limit,))
-    rows = cur.fetchall()
-    return [{"display_name": r[0], "message_count": r[1]} for r in rows]
+    def flush(self):
+        # _db_lock covers the snapshot as well as the write, so close() cannot
+        # slip in between a tick clearing dirty and its commit landing.
+        with self._db_lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        with self._lock:
+            rows = [
+                (uid, u["display_name"], u["message_count"], u["first_seen"], u["last_seen"])
+                for uid, u in ((uid, self.users[uid]) for uid in self.dirty)
+            ]
+            self.dirty.clear()
+        if not rows:
+            return
+        try:
+            with transaction(self.conn):
+                self.conn.executemany(SQL_UPSERT_USER, rows)
+        except sqlite3.Error:
+            with self._lock:
+                self.dirty.update(r[0] for r in rows)
+            raise
+
+    def start(self):
+        self._timer = threading.Timer(self.flush_interval, self._tick)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _tick(self):
+        with self._db_lock:
+            if self._closed:
+                return
+            try:
+                self._flush_locked()
+            except sqlite3.Error as e:
+                print(f"[{BOT_NAME}] User flush failed: {e}")
+        self.start()
+
+    def close(self):
+        # Waits for an in-flight tick; any tick after this sees _closed and stops.
+        self._closed = True
+        if self._timer:
+            self._timer.cancel()
+        self.flush()
+
+def get_user_stats(users: UserCache, user_id: str) -> Optional[Dict[str, Any]]:
+    return users.get(user_id)
+
+def top_chatters(users: UserCache, limit=5) -> List[Dict[str, Any]]:
+    return users.top(limit)
 
 def get_credentials() -> Credentials:
     creds = None
@@ -101,9 +250,9 @@ def get_credentials() -> Credentials:
             token.write(creds.to_json())
     return creds
 
-def yt_service():
-    creds = get_credentials()
-    return build("youtube", "v3", credentials=creds)
+def yt_service(creds: Credentials):
+    # Use the discovery document bundled with google-api-python-client instead of fetching it.
+    return build("youtube", "v3", credentials=creds, static_discovery=True, cache_discovery=False)
 
 def get_active_live_chat_id(youtube):
     broadcasts = youtube.liveBroadcasts().list(
@@ -120,6 +269,39 @@ def get_active_live_chat_id(youtube):
     started_at = items[0]["snippet"].get("actualStartTime")
     return live_chat_id, started_at
 
+class StreamUnavailable(RuntimeError):
+    pass
+
+def stream_chat(creds: Credentials, live_chat_id: str, page_token: Optional[str] = None):
+    # streamList pushes LiveChatMessageListResponse objects as a JSON array that
+    # grows over the life of the connection; decode each object as it completes.
+    params = {"liveChatId": live_chat_id, "part": "snippet,authorDetails"}
+    if page_token:
+        params["pageToken"] = page_token
+    # The read timeout bounds the silence between chunks, so a stalled connection
+    # surfaces as an error and gets reopened instead of hanging the bot.
+    with AuthorizedSession(creds) as session, \
+            session.get(STREAM_URL, params=params, stream=True, timeout=(10, STREAM_READ_TIMEOUT)) as r:
+        # 429 is a throttle, not a missing feature; raise_for_status sends it to the reconnect back-off.
+        if 400 <= r.status_code < 500 and r.status_code != 429:
+            raise StreamUnavailable(f"HTTP {r.status_code}")
+        r.raise_for_status()
+        r.encoding = r.encoding or "utf-8"
+        decoder = json.JSONDecoder()
+        buf = ""
+        for chunk in r.iter_content(chunk_size=None, decode_unicode=True):
+            buf += chunk
+            while True:
+                buf = buf.lstrip("[,] \r\n\t")
+                if not buf:
+                    break
+                try:
+                    obj, end = decoder.raw_decode(buf)
+                except ValueError:
+                    break
+                buf = buf[end:]
+                yield obj
+
 def send_chat_message(youtube, live_chat_id: str, text: str):
     body = {
         "snippet": {
@@ -130,35 +312,238 @@ def send_chat_message(youtube, live_chat_id: str, text: str):
     }
     youtube.liveChatMessages().insert(part="snippet", body=body).execute()
 
+class ChatOutbox:
+    # Sends replies from a background thread so the chat loop never blocks on
+    # an insert. The worker owns its own client: httplib2 is not thread-safe.
+    def __init__(self, creds: Credentials, send_interval: float = SEND_INTERVAL_SECS):
+        self.youtube = yt_service(creds)
+        self.send_interval = send_interval
+        self.queue: "queue.Queue[Optional[Tuple[str, str]]]" = queue.Queue()
+        self._thread = threading.Thread(target=self._worker, name="chat-outbox", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def send(self, live_chat_id: str, text: str):
+        self.queue.put((live_chat_id, text))
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            live_chat_id, text = item
+            try:
+                send_chat_message(self.youtube, live_chat_id, text)
+            except Exception as e:
+                print(f"[{BOT_NAME}] Send failed: {e}")
+            time.sleep(self.send_interval)
+
+    def close(self, timeout: float = 10.0):
+        # Drain whatever is already queued, then stop.
+        self.queue.put(None)
+        self._thread.join(timeout)
+
+class SemanticCache:
+    # Replies keyed by unit-length prompt embeddings, held in a fixed-size numpy
+    # ring so a lookup is one matmul. A hit is the nearest stored prompt by
+    # cosine similarity, if it clears the threshold.
+    def __init__(self, model: str, path: str = SEMANTIC_CACHE_FILE, threshold: float = SEMANTIC_CACHE_THRESHOLD,
+                 max_size: int = SEMANTIC_CACHE_SIZE, save_every: int = 20):
+        self.model = model
+        self.path = path
+        self.threshold = threshold
+        self.max_size = max_size
+        self.save_every = save_every
+        self.vecs = None
+        self.replies: List[str] = [""] * max_size
+        self.size = 0
+        self.next = 0
+        self.lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._unsaved = 0
+        self.load()
+
+    def _append(self, vec, reply: str):
+        if self.vecs is None:
+            self.vecs = np.zeros((self.max_size, vec.shape[0]), dtype=np.float32)
+        self.vecs[self.next] = vec
+        self.replies[self.next] = reply
+        self.next = (self.next + 1) % self.max_size
+        self.size = min(self.size + 1, self.max_size)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with np.load(self.path) as data:
+                if str(data["model"]) != self.model:
+                    return
+                vecs, replies = data["vecs"], data["replies"]
+            for vec, reply in zip(vecs[-self.max_size:], replies[-self.max_size:]):
+                self._append(vec, str(reply))
+        except (OSError, ValueError, KeyError):
+            self.vecs, self.size, self.next = None, 0, 0
+
+    def save(self):
+        # One writer at a time, and readers only ever see a complete file.
+        with self._save_lock:
+            with self.lock:
+                if not self.size:
+                    return
+                order = (np.arange(self.size) + (self.next if self.size == self.max_size else 0)) % self.max_size
+                vecs = self.vecs[order]
+                replies = np.array([self.replies[i] for i in order])
+                self._unsaved = 0
+            tmp = self.path + ".tmp"
+            with open(tmp, "wb") as f:
+                np.savez(f, model=np.array(self.model), vecs=vecs, replies=replies)
+            os.replace(tmp, self.path)
+
+    def lookup(self, vec) -> Optional[str]:
+        with self.lock:
+            if not self.size:
+                return None
+            scores = self.vecs[:self.size] @ vec
+            i = int(np.argmax(scores))
+            return self.replies[i] if scores[i] >= self.threshold else None
+
+    def add(self, vec, reply: str):
+        with self.lock:
+            self._append(vec, reply)
+            self._unsaved += 1
+            due = self._unsaved >= self.save_every
+        if due:
+            try:
+                self.save()
+            except OSError:
+                pass
+
 class AI:
     def __init__(self):
         self.provider = LLM_PROVIDER
         self.client = None
+        self.cache: Optional[SemanticCache] = None
+        self._encoder = None
+        self._cache_lock = threading.Lock()
+        self._cache_loading = False
+        self._cache_disabled = SEMANTIC_CACHE == "0" or np is None
+        # Replies are generated off the chat loop so polling keeps going meanwhile.
+        self.pool = ThreadPoolExecutor(max_workers=AI_WORKERS, thread_name_prefix="ai")
         if self.provider == "openai":
             if not OPENAI_API_KEY or OpenAI is None:
                 self.provider = "none"
             else:
-                self.client = OpenAI(api_key=OPENAI_API_KEY)
+                self.client = OpenAI(api_key=OPENAI_API_KEY, timeout=10)
+        # Exact-match LRU in front of the semantic cache; failed completions are not cached.
+        self._replies: "OrderedDict[str, str]" = OrderedDict()
+        self._replies_lock = threading.Lock()
+
+    def _get_cache(self) -> Optional[SemanticCache]:
+        # The first caller loads the encoder and cache outside the lock; other
+        # workers skip the cache until it is ready instead of waiting on the load.
+        with self._cache_lock:
+            if self.cache is not None or self._cache_loading or self._cache_disabled:
+                return self.cache
+            self._cache_loading = True
+        encoder = None
+        try:
+            if SentenceTransformer is not None:
+                try:
+                    encoder = SentenceTransformer(LOCAL_EMBED_MODEL)
+                except Exception:
+                    encoder = None
+            if encoder is not None:
+                cache = SemanticCache(LOCAL_EMBED_MODEL)
+            elif SEMANTIC_CACHE == "1":
+                cache = SemanticCache(OPENAI_EMBED_MODEL)
+            else:
+                cache = None
+            with self._cache_lock:
+                self._encoder = encoder
+                self.cache = cache
+                self._cache_disabled = cache is None
+        finally:
+            with self._cache_lock:
+                self._cache_loading = False
+        return self.cache
+
+    def _embed(self, text: str):
+        if self._encoder is not None:
+            return self._encoder.encode(text, normalize_embeddings=True).astype(np.float32)
+        # OpenAI embeddings are already normalized to unit length.
+        resp = self.client.embeddings.create(model=OPENAI_EMBED_MODEL, input=text)
+        return np.asarray(resp.data[0].embedding, dtype=np.float32)
+
+    def _complete(self, key: str, prompt: str) -> str:
+        vec = None
+        try:
+            cache = self._get_cache()
+            if cache is not None:
+                vec = self._embed(key)
+                hit = cache.lookup(vec)
+                if hit:
+                    return hit
+        except Exception:
+            vec = None
+        # The viewer's name is left out so cached replies fit any viewer.
+        stream = self.client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": prompt},
+            ],
+            temperature=0.6,
+            max_tokens=120,
+            stream=True,
+            extra_body={"prompt_cache_key": PROMPT_CACHE_KEY},
+        )
+        parts = []
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+        text = "".join(parts).strip()
+        if not text:
+            # Filtered, refused or empty completions must not be cached or sent.
+            raise RuntimeError("Empty completion")
+        if vec is not None:
+            self.cache.add(vec, text)
+        return text
 
     def reply(self, user_text: str, username: str) -> str:
         if self.provider == "openai":
+            prompt = user_text[:MAX_PROMPT_CHARS].strip()
+            # Casefolded text is only the cache key; the model sees what the viewer typed.
+            key = prompt.casefold()
+            with self._replies_lock:
+                hit = self._replies.get(key)
+                if hit is not None:
+                    self._replies.move_to_end(key)
+                    return hit
             try:
-                prompt = (
-                    f"You are {BOT_NAME}, a witty but kind livestream co-host. "
-                    f"Keep answers concise. "
-                    f"User {username} says: {user_text}"
-                )
-                resp = self.client.chat.completions.create(
-                    model="gpt-4o-mini",
-                    messages=[{"role": "user", "content": prompt}],
-                    temperature=0.6,
-                    max_tokens=120,
-                )
-                return resp.choices[0].message.content.strip()
+                text = self._complete(key, prompt)
             except Exception:
                 pass
+            else:
+                with self._replies_lock:
+                    self._replies[key] = text
+                    self._replies.move_to_end(key)
+                    if len(self._replies) > REPLY_CACHE_SIZE:
+                        self._replies.popitem(last=False)
+                return text
         return f"{username}, interesting!"
 
+    def submit(self, user_text: str, username: str) -> Future:
+        return self.pool.submit(self.reply, user_text, username)
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        if self.cache is not None:
+            try:
+                self.cache.save()
+            except OSError as e:
+                print(f"[{BOT_NAME}] Could not save reply cache: {e}")
+
 @dataclass
 class ChatMessage:
     id: str
@@ -170,100 +555,197 @@ class ChatMessage:
     is_member: bool
     published_at: str
 
-def parse_command(text: str) -> Optional[Dict[str, Any]]:
+@dataclass
+class ChatCommand:
+    __slots__ = ("cmd", "args")
+    cmd: str
+    args: List[str]
+
+def parse_command(text: str) -> Optional[ChatCommand]:
     if not text or not text.startswith("!"):
         return None
-    parts = text.strip().split()
-    cmd = parts[0].lower()
-    args = parts[1:]
-    return {"cmd": cmd, "args": args}
-
-def handle_command(cmd: str, args: List[str], msg: ChatMessage, youtube, live_chat_id: str, conn):
-    if cmd in ("!help", "!commands"):
-        send_chat_message(youtube, live_chat_id,
-            f"Commands: !help, !stats, !uptime, !top. Ask AI with '?your question'.")
-    elif cmd == "!stats":
-        stats = get_user_stats(conn, msg.user_id)
-        if stats:
-            send_chat_message(youtube, live_chat_id,
-                f"{msg.display_name}: {stats['message_count']} messages. First seen {stats['first_seen'][:10]}.")
-        else:
-            send_chat_message(youtube, live_chat_id, f"{msg.display_name}: I’m just meeting you!")
-    elif cmd == "!top":
-        top5 = top_chatters(conn, 5)
-        board = " • ".join([f"{i+1}. {u['display_name']}({u['message_count']})" for i, u in enumerate(top5)])
-        send_chat_message(youtube, live_chat_id, f"Top chatters: {board}")
-    elif cmd == "!uptime":
-        send_chat_message(youtube, live_chat_id, "I’ve been here since the stream started.")
-    elif cmd == "!settitle":
-        if not (msg.is_mod or msg.is_owner):
-            send_chat_message(youtube, live_chat_id, "Only mods or the owner can do that.")
-        else:
-            send_chat_message(youtube, live_chat_id, "Title updates aren’t wired in this sample.")
+    parts = text.split(None, 1)
+    return ChatCommand(parts[0].lower(), parts[1].split() if len(parts) > 1 else [])
+
+def _help(msg: ChatMessage, outbox: ChatOutbox, live_chat_id: str, users: UserCache, args: List[str]):
+    outbox.send(live_chat_id, HELP_TEXT)
+
+def _stats(msg: ChatMessage, outbox: ChatOutbox, live_chat_id: str, users: UserCache, args: List[str]):
+    stats = get_user_stats(users, msg.user_id)
+    if stats:
+        outbox.send(live_chat_id,
+            f"{msg.display_name}: {stats['message_count']} messages. First seen {stats['first_seen'][:10]}.")
     else:
-        send_chat_message(youtube, live_chat_id, f"Unknown command. Try !help")
+        outbox.send(live_chat_id, f"{msg.display_name}: I’m just meeting you!")
+
+def _top(msg: ChatMessage, outbox: ChatOutbox, live_chat_id: str, users: UserCache, args: List[str]):
+    top5 = top_chatters(users, 5)
+    board = " • ".join([f"{i+1}. {u['display_name']}({u['message_count']})" for i, u in enumerate(top5)])
+    outbox.send(live_chat_id, f"Top chatters: {board}")
 
-def check_achievements(conn, youtube, live_chat_id: str, msg: ChatMessage, new_count: int):
+def _uptime(msg: ChatMessage, outbox: ChatOutbox, live_chat_id: str, users: UserCache, args: List[str]):
+    outbox.send(live_chat_id, UPTIME_TEXT)
+
+def _settitle(msg: ChatMessage, outbox: ChatOutbox, live_chat_id: str, users: UserCache, args: List[str]):
+    if not (msg.is_mod or msg.is_owner):
+        outbox.send(live_chat_id, MODS_ONLY_TEXT)
+    else:
+        outbox.send(live_chat_id, SETTITLE_TEXT)
+
+def _unknown(msg: ChatMessage, outbox: ChatOutbox, live_chat_id: str, users: UserCache, args: List[str]):
+    outbox.send(live_chat_id, UNKNOWN_TEXT)
+
+COMMANDS = {
+    "!help": _help,
+    "!commands": _help,
+    "!stats": _stats,
+    "!top": _top,
+    "!uptime": _uptime,
+    "!settitle": _settitle,
+}
+
+def handle_command(cmd: str, args: List[str], msg: ChatMessage, outbox: ChatOutbox, live_chat_id: str, users: UserCache):
+    COMMANDS.get(cmd, _unknown)(msg, outbox, live_chat_id, users, args)
+
+def check_achievements(users: UserCache, outbox: ChatOutbox, live_chat_id: str, msg: ChatMessage, new_count: int):
     if new_count in ACHIEVEMENT_TIERS:
-        tier_msg = {
-            1: "first message 🎉",
-            10: "10 messages 🔟",
-            50: "50 messages 🥳",
-            100: "100 messages 💯",
-            250: "250 messages 🚀",
-            500: "500 messages 🐐",
-        }.get(new_count, f"{new_count} messages 🎊")
-        send_chat_message(
-            youtube, live_chat_id,
-            f"{msg.display_name} just hit {tier_msg}!"
-        )
+        tier_msg = TIER_MSG.get(new_count) or f"{new_count} messages 🎊"
+        outbox.send(live_chat_id, f"{msg.display_name} just hit {tier_msg}!")
 
-def run():
-    conn = db_connect()
-    ai = AI()
-    youtube = yt_service()
-    live_chat_id, started_at = get_active_live_chat_id(youtube)
-    print(f"[{BOT_NAME}] Connected. LiveChatId={live_chat_id}")
+def clip_reply(reply: str) -> str:
+    if len(reply) > 250:
+        reply = reply[:247] + "..."
+    return reply
+
+def handle_item(item: Dict[str, Any], outbox: ChatOutbox, live_chat_id: str, users: UserCache, ai: AI, now_iso: str):
+    msg_id = item["id"]
+    snippet = item["snippet"]
+    author = item["authorDetails"]
+    cm = ChatMessage(
+        id=msg_id,
+        user_id=author["channelId"],
+        display_name=author["displayName"],
+        text=snippet["displayMessage"],
+        is_mod=author.get("isChatModerator", False),
+        is_owner=author.get("isChatOwner", False),
+        is_member=author.get("isChatSponsor", False),
+        published_at=snippet["publishedAt"]
+    )
+    new_count = users.record(cm.user_id, cm.display_name, now_iso)
+    check_achievements(users, outbox, live_chat_id, cm, new_count)
+    c = parse_command(cm.text)
+    if c:
+        handle_command(c.cmd, c.args, cm, outbox, live_chat_id, users)
+        return
+    trigger = cm.text.lstrip().startswith("?") or BOT_MENTION.search(cm.text) is not None
+    if trigger:
+        prompt = cm.text.lstrip("?").strip()
+        if not prompt:
+            return
+        ai.submit(prompt, cm.display_name).add_done_callback(
+            lambda f: outbox.send(live_chat_id, clip_reply(f.result())))
+
+class RecentIds:
+    # Remembers the last maxlen message ids so replays after a page token reset
+    # or stream reconnect are skipped, without growing for the whole stream.
+    def __init__(self, maxlen: int = 4096):
+        self.ids = set()
+        self.order = deque(maxlen=maxlen)
+
+    def add(self, msg_id: str) -> bool:
+        if msg_id in self.ids:
+            return False
+        if len(self.order) == self.order.maxlen:
+            self.ids.discard(self.order[0])
+        self.order.append(msg_id)
+        self.ids.add(msg_id)
+        return True
+
+def handle_items(items: List[Dict[str, Any]], outbox: ChatOutbox, live_chat_id: str, users: UserCache, ai: AI,
+                 seen: RecentIds):
+    # One clock read per batch; every message in it shares the timestamp.
+    now_iso = dt.datetime.utcnow().isoformat()
+    for item in items:
+        if seen.add(item["id"]):
+            handle_item(item, outbox, live_chat_id, users, ai, now_iso)
+
+def next_poll_interval(polling_ms: int, idle_polls: int) -> float:
+    # Never poll sooner than the server asks (it answers 403 rateLimitExceeded);
+    # only stretch the wait, exponentially, while chat stays idle.
+    base = max(polling_ms, POLL_MIN_MS)
+    ms = base * 2 ** min(max(idle_polls - 1, 0), 4)
+    return max(min(ms, POLL_MAX_MS), base) / 1000.0
+
+def is_rate_limited(e: HttpError) -> bool:
+    return e.resp.status == 403 and b"rateLimitExceeded" in (e.content or b"")
+
+def listen(creds: Credentials, youtube, outbox: ChatOutbox, live_chat_id: str, users: UserCache, ai: AI):
     page_token = None
+    seen = RecentIds()
+    if CHAT_STREAMING:
+        # Network trouble reopens the stream from the last token; only a 4xx on
+        # connect means streaming isn't available and we should poll instead.
+        backoff = 1.0
+        while True:
+            try:
+                for resp in stream_chat(creds, live_chat_id, page_token):
+                    backoff = 1.0
+                    page_token = resp.get("nextPageToken", page_token)
+                    handle_items(resp.get("items", []), outbox, live_chat_id, users, ai, seen)
+            except StreamUnavailable as e:
+                print(f"[{BOT_NAME}] Chat streaming unavailable ({e}), falling back to polling.")
+                break
+            except requests.RequestException as e:
+                print(f"[{BOT_NAME}] Chat stream dropped ({e}), reconnecting in {backoff:.0f}s.")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60.0)
+    polling_ms = 2000
+    idle_polls = 0
+    rate_limited = 0
     while True:
-        resp = youtube.liveChatMessages().list(
-            liveChatId=live_chat_id,
-            part="snippet,authorDetails",
-            pageToken=page_token or None
-        ).execute()
+        try:
+            resp = youtube.liveChatMessages().list(
+                liveChatId=live_chat_id,
+                part="snippet,authorDetails",
+                pageToken=page_token or None
+            ).execute()
+        except HttpError as e:
+            if not is_rate_limited(e):
+                raise
+            rate_limited += 1
+            print(f"[{BOT_NAME}] Rate limited by YouTube, backing off.")
+            time.sleep(next_poll_interval(polling_ms, rate_limited + 1))
+            continue
+        rate_limited = 0
         polling_ms = resp.get("pollingIntervalMillis", 2000)
         page_token = resp.get("nextPageToken")
-        for item in resp.get("items", []):
-            msg_id = item["id"]
-            snippet = item["snippet"]
-            author = item["authorDetails"]
-            cm = ChatMessage(
-                id=msg_id,
-                user_id=author["channelId"],
-                display_name=author["displayName"],
-                text=snippet["displayMessage"],
-                is_mod=author.get("isChatModerator", False),
-                is_owner=author.get("isChatOwner", False),
-                is_member=author.get("isChatSponsor", False),
-                published_at=snippet["publishedAt"]
-            )
-            upsert_user(conn, cm.user_id, cm.display_name)
-            new_count = bump_message_count(conn, cm.user_id)
-            check_achievements(conn, youtube, live_chat_id, cm, new_count)
-            c = parse_command(cm.text)
-            if c:
-                handle_command(c["cmd"], c["args"], cm, youtube, live_chat_id, conn)
-                continue
-            trigger = cm.text.strip().startswith("?") or BOT_NAME.lower() in cm.text.lower()
-            if trigger:
-                prompt = cm.text.lstrip("?").strip()
-                if not prompt:
-                    continue
-                reply = ai.reply(prompt, cm.display_name)
-                if len(reply) > 250:
-                    reply = reply[:247] + "..."
-                send_chat_message(youtube, live_chat_id, reply)
-        time.sleep(max(1.0, polling_ms / 1000.0))
+        items = resp.get("items", [])
+        idle_polls = 0 if items else idle_polls + 1
+        handle_items(items, outbox, live_chat_id, users, ai, seen)
+        time.sleep(next_poll_interval(polling_ms, idle_polls))
+
+def run():
+    users = UserCache(db_connect())
+    users.start()
+    try:
+        ai = AI()
+        creds = get_credentials()
+        youtube = yt_service(creds)
+        live_chat_id, started_at = get_active_live_chat_id(youtube)
+        print(f"[{BOT_NAME}] Connected. LiveChatId={live_chat_id}")
+        outbox = ChatOutbox(creds)
+        outbox.start()
+        try:
+            listen(creds, youtube, outbox, live_chat_id, users, ai)
+        finally:
+            # Let in-flight replies reach the outbox before draining it.
+            ai.close()
+            outbox.close()
+    finally:
+        try:
+            users.close()
+        except sqlite3.Error as e:
+            print(f"[{BOT_NAME}] Final user flush failed: {e}")
 
 if __name__ == "__main__":
     try: